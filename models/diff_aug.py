@@ -4,34 +4,53 @@ from torch.distributions.dirichlet import _Dirichlet
 
 
 # ------------------ augmentation functions ------------------
+# Each function draws its random tensors from `buffers` when given (see DiffAugmentRunner), otherwise
+# it allocates them; `slot` separates buffers of the same shape used in one call (the mixup branch).
 
 
-def rand_brightness(x):
-    x = x + (torch.rand(x.size(0), 1, 1, 1, dtype=x.dtype, device=x.device) - 0.5)
+def _empty(buffers, name, slot, shape, dtype, device):
+    if buffers is None:
+        return torch.empty(shape, dtype=dtype, device=device)
+    return buffers.buffer(name, slot, shape, dtype, device)
+
+
+def _meshgrid(buffers, size_0, size_1, size_2, device):
+    if buffers is not None:
+        return buffers.grid(size_0, size_1, size_2, device)
+    return torch.meshgrid(
+        torch.arange(size_0, dtype=torch.long, device=device),
+        torch.arange(size_1, dtype=torch.long, device=device),
+        torch.arange(size_2, dtype=torch.long, device=device),
+    )
+
+
+def rand_brightness(x, buffers=None, slot=0):
+    r = _empty(buffers, 'brightness', slot, (x.size(0), 1, 1, 1), x.dtype, x.device).uniform_()
+    x = x + (r - 0.5)
     return x
 
 
-def rand_saturation(x):
+def rand_saturation(x, buffers=None, slot=0):
+    r = _empty(buffers, 'saturation', slot, (x.size(0), 1, 1, 1), x.dtype, x.device).uniform_(0, 2)
     x_mean = x.mean(dim=1, keepdim=True)
-    x = (x - x_mean) * (torch.rand(x.size(0), 1, 1, 1, dtype=x.dtype, device=x.device) * 2) + x_mean
+    x = (x - x_mean) * r + x_mean
     return x
 
 
-def rand_contrast(x):
+def rand_contrast(x, buffers=None, slot=0):
+    r = _empty(buffers, 'contrast', slot, (x.size(0), 1, 1, 1), x.dtype, x.device).uniform_(0.5, 1.5)
     x_mean = x.mean(dim=[1, 2, 3], keepdim=True)
-    x = (x - x_mean) * (torch.rand(x.size(0), 1, 1, 1, dtype=x.dtype, device=x.device) + 0.5) + x_mean
+    x = (x - x_mean) * r + x_mean
     return x
 
 
-def rand_translation(x, ratio=0.125):
+def rand_translation(x, ratio=0.125, buffers=None, slot=0):
     shift_x, shift_y = int(x.size(2) * ratio + 0.5), int(x.size(3) * ratio + 0.5)
-    translation_x = torch.randint(-shift_x, shift_x + 1, size=[x.size(0), 1, 1], device=x.device)
-    translation_y = torch.randint(-shift_y, shift_y + 1, size=[x.size(0), 1, 1], device=x.device)
-    grid_batch, grid_x, grid_y = torch.meshgrid(
-        torch.arange(x.size(0), dtype=torch.long, device=x.device),
-        torch.arange(x.size(2), dtype=torch.long, device=x.device),
-        torch.arange(x.size(3), dtype=torch.long, device=x.device),
-    )
+    translation_x = _empty(buffers, 'translation_x', slot, (x.size(0), 1, 1), torch.long, x.device)
+    translation_y = _empty(buffers, 'translation_y', slot, (x.size(0), 1, 1), torch.long, x.device)
+    translation_x.random_(-shift_x, shift_x + 1)
+    translation_y.random_(-shift_y, shift_y + 1)
+    grid_batch, grid_x, grid_y = _meshgrid(buffers, x.size(0), x.size(2), x.size(3), x.device)
     grid_x = torch.clamp(grid_x + translation_x + 1, 0, x.size(2) + 1)
     grid_y = torch.clamp(grid_y + translation_y + 1, 0, x.size(3) + 1)
     x_pad = F.pad(x, [1, 1, 1, 1, 0, 0, 0, 0])
@@ -39,25 +58,24 @@ def rand_translation(x, ratio=0.125):
     return x
 
 
-def rand_cutout(x, ratio=0.5):
+def rand_cutout(x, ratio=0.5, buffers=None, slot=0):
     cutout_size = int(x.size(2) * ratio + 0.5), int(x.size(3) * ratio + 0.5)
-    offset_x = torch.randint(0, x.size(2) + (1 - cutout_size[0] % 2), size=[x.size(0), 1, 1], device=x.device)
-    offset_y = torch.randint(0, x.size(3) + (1 - cutout_size[1] % 2), size=[x.size(0), 1, 1], device=x.device)
-    grid_batch, grid_x, grid_y = torch.meshgrid(
-        torch.arange(x.size(0), dtype=torch.long, device=x.device),
-        torch.arange(cutout_size[0], dtype=torch.long, device=x.device),
-        torch.arange(cutout_size[1], dtype=torch.long, device=x.device),
-    )
+    offset_x = _empty(buffers, 'offset_x', slot, (x.size(0), 1, 1), torch.long, x.device)
+    offset_y = _empty(buffers, 'offset_y', slot, (x.size(0), 1, 1), torch.long, x.device)
+    offset_x.random_(0, x.size(2) + (1 - cutout_size[0] % 2))
+    offset_y.random_(0, x.size(3) + (1 - cutout_size[1] % 2))
+    grid_batch, grid_x, grid_y = _meshgrid(buffers, x.size(0), cutout_size[0], cutout_size[1], x.device)
     grid_x = torch.clamp(grid_x + offset_x - cutout_size[0] // 2, min=0, max=x.size(2) - 1)
     grid_y = torch.clamp(grid_y + offset_y - cutout_size[1] // 2, min=0, max=x.size(3) - 1)
-    mask = torch.ones(x.size(0), x.size(2), x.size(3), dtype=x.dtype, device=x.device)
+    mask = _empty(buffers, 'mask', slot, (x.size(0), x.size(2), x.size(3)), x.dtype, x.device).fill_(1)
     mask[grid_batch, grid_x, grid_y] = 0
     x = x * mask.unsqueeze(1)
     return x
 
 
-def noise(x, sd=0.05):
-    x = x + torch.randn_like(x) * sd * sd
+def noise(x, sd=0.05, buffers=None, slot=0):
+    r = _empty(buffers, 'noise', slot, x.shape, x.dtype, x.device).normal_()
+    x = x + r * sd * sd
     return x
 
 
@@ -78,44 +96,79 @@ def BetaSample(alpha, beta, sample_shape=torch.Size()):
     return _Dirichlet.apply(concentration).select(-1, 0)
 
 
-def DiffAugment(x, policy='', channels_first=True):
-    if policy:
-        x_ori = x.clone()
-
-        if not channels_first:
-            x = x.permute(0, 3, 1, 2)
-
+class DiffAugmentRunner:
+    # DiffAugment with a pool of random tensors and index grids, allocated once per (shape, dtype, device)
+    # and refilled in place on every call. Pass reuse_buffers=False to allocate fresh tensors instead.
+    #
+    # Restriction: the saturation/contrast factors and the cutout mask are saved for backward, so with
+    # reuse_buffers=True every output must be backpropagated (or dropped) before the runner is called
+    # again with the same shape; otherwise autograd raises a version-counter error. The mixup branch uses
+    # its own buffers (slot 1), so a single call is always safe.
+
+    def __init__(self, reuse_buffers=True):
+        self.reuse_buffers = reuse_buffers
+        self._buffers = {}
+        self._grids = {}
+
+    def buffer(self, name, slot, shape, dtype, device):
+        key = (name, slot, torch.Size(shape), dtype, device)
+        if key not in self._buffers:
+            self._buffers[key] = torch.empty(shape, dtype=dtype, device=device)
+        return self._buffers[key]
+
+    def grid(self, size_0, size_1, size_2, device):
+        key = (size_0, size_1, size_2, device)
+        if key not in self._grids:
+            self._grids[key] = _meshgrid(None, size_0, size_1, size_2, device)
+        return self._grids[key]
+
+    def augment(self, x, policy, slot=0):
+        buffers = self if self.reuse_buffers else None
         for p in policy.split(','):
-            if p in list(AUGMENT_FNS.keys()):
+            if p in AUGMENT_FNS:
                 for f in AUGMENT_FNS[p]:
-                    x = f(x)
+                    x = f(x, buffers=buffers, slot=slot)
+        return x
 
-        if not channels_first:
-            x = x.permute(0, 2, 3, 1)
+    def __call__(self, x, policy='', channels_first=True):
+        if policy:
+            x_ori = x.clone()
 
-        x = x.contiguous()
+            if not channels_first:
+                x = x.permute(0, 3, 1, 2)
+
+            x = self.augment(x, policy)
 
-        if 'mixup' in policy:
             if not channels_first:
-                x1 = x_ori.permute(0, 3, 1, 2)
+                x = x.permute(0, 2, 3, 1)
 
-            else:
-                x1 = x_ori.clone()
+            x = x.contiguous()
 
-            for p in policy.split(','):
-                if p in list(AUGMENT_FNS.keys()):
-                    for f in AUGMENT_FNS[p]:
-                        x1 = f(x1)
+            if 'mixup' in policy:
+                if not channels_first:
+                    x1 = x_ori.permute(0, 3, 1, 2)
 
-            if not channels_first:
-                x1 = x1.permute(0, 2, 3, 1)
+                else:
+                    x1 = x_ori.clone()
 
-            x1 = x1.contiguous()
+                x1 = self.augment(x1, policy, slot=1)
 
-            # TODO
-            alpha = torch.ones(x.size(0), 1, 1, 1, dtype=x.dtype, device=x.device) * 0.1
-            beta = torch.ones(x.size(0), 1, 1, 1, dtype=x.dtype, device=x.device) * 0.1
-            weight = BetaSample(alpha, beta)
-            x = (1 - weight) * x1 + weight * x
+                if not channels_first:
+                    x1 = x1.permute(0, 2, 3, 1)
 
-    return x
+                x1 = x1.contiguous()
+
+                # TODO
+                alpha = torch.ones(x.size(0), 1, 1, 1, dtype=x.dtype, device=x.device) * 0.1
+                beta = torch.ones(x.size(0), 1, 1, 1, dtype=x.dtype, device=x.device) * 0.1
+                weight = BetaSample(alpha, beta)
+                x = (1 - weight) * x1 + weight * x
+
+        return x
+
+
+_fresh_runner = DiffAugmentRunner(reuse_buffers=False)
+
+
+def DiffAugment(x, policy='', channels_first=True):
+    return _fresh_runner(x, policy=policy, channels_first=channels_first)
@@ -1,28 +1,119 @@
+import os
+from contextlib import nullcontext
 from functools import partial
 from pathlib import Path
 
-import matplotlib.pyplot as plt
-import numpy as np
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 
 import torch
+import torch.distributed as dist
 from torch import nn
 from torch.nn import functional as F
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data import DataLoader, DistributedSampler, TensorDataset
+from torchvision.utils import make_grid, save_image
 
-from models.diff_aug import DiffAugment
+from models.diff_aug import DiffAugmentRunner
 from models.losses import loss_hinge_dis, loss_hinge_gen
 from models.modules import SNLinear, GBlock, SNConv2d, CCBN, BN, SNEmbedding, DBlock
 from scripts.spec2rgb import ColourSystem
 
 
+_NUM_WARMUP_ITERS = 3
+_POSTFIX_EVERY_ITERS = 50
+
+
+# ---------------- Distributed training ---------------- #
+
+def local_rank(rank=0):
+    # the CUDA device index is the rank within the node; torchrun exports it as LOCAL_RANK
+    # (single-node launchers that do not set it have local rank == global rank)
+    return int(os.environ.get('LOCAL_RANK', rank))
+
+
+def setup_ddp(rank, world_size):
+    # launch with `torchrun --nproc_per_node=N`, which exports RANK, LOCAL_RANK, WORLD_SIZE and MASTER_ADDR/PORT
+    dist.init_process_group('nccl', rank=rank, world_size=world_size)
+    torch.cuda.set_device(local_rank(rank))
+
+
+def cleanup_ddp():
+    dist.destroy_process_group()
+
+
+# ---------------- Checkpoints ---------------- #
+
+def load_weights(path):
+    # memory-map the file instead of reading it into host memory; load_state_dict then copies each tensor
+    # into the existing (device, dtype, memory format) parameters, so optimizers keep their references
+    return torch.load(path, map_location='cpu', weights_only=True, mmap=True)
+
+
+# ---------------- Mixed precision ---------------- #
+
+def frozen_autocast(module):
+    # a frozen network already cast to bf16 computes in bf16; disable the surrounding fp16 autocast so its
+    # weights are not re-cast to fp16 on every conv (fp32 networks keep the surrounding autocast)
+    if module[0].weight.dtype == torch.bfloat16:
+        return torch.autocast('cuda', enabled=False)
+    return nullcontext()
+
+
+# ---------------- CUDA graphs ---------------- #
+
+def graph_module(module, sample_args, num_warmup_iters=_NUM_WARMUP_ITERS):
+    # capture forward/backward once for the sample shapes; other shapes (e.g. last batch) run eagerly.
+    # The graphed backward hands out views of static grad buffers that the next replay overwrites, so
+    # gradients cannot be accumulated over several replays: set module.replay_graph = False for that
+    eager_forward = module.forward
+    static_shapes = [arg.shape for arg in sample_args]
+
+    torch.cuda.make_graphed_callables(module, sample_args, num_warmup_iters=num_warmup_iters)
+    graphed_forward = module.forward
+
+    def forward(*args):
+        if not module.replay_graph or [arg.shape for arg in args] != static_shapes:
+            return eager_forward(*args)
+        return graphed_forward(*args)
+
+    module.forward = forward
+    module.eager_forward = eager_forward
+    module.replay_graph = True
+    return module
+
+
+def check_graph_accumulation(module, sample_args, num_accum=2):
+    # gradients accumulated over micro-batches the way train_step does it (graph replay disabled) must
+    # match plain eager execution; eval mode keeps the SN power iteration from changing between runs
+    def accumulate(forward):
+        module.zero_grad(set_to_none=True)
+        for _ in range(num_accum):
+            forward(*sample_args).float().sum().backward()
+        grads = [param.grad.detach().clone() for param in module.parameters() if param.grad is not None]
+        module.zero_grad(set_to_none=True)
+        return grads
+
+    training, replay_graph = module.training, module.replay_graph
+    module.eval()
+    module.replay_graph = False
+    accumulated = accumulate(module.forward)
+    module.replay_graph = replay_graph
+    eager = accumulate(module.eager_forward)
+    module.train(training)
+
+    if len(accumulated) != len(eager) or not all(torch.allclose(a, e) for a, e in zip(accumulated, eager)):
+        raise RuntimeError('gradients accumulated around the CUDA graph differ from eager execution')
+
+
 # =#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#
 # baseline
 # =#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#
 
 class LCGAN:
     def __init__(self, batch_size, latent_dim, num_classes, epochs, ema_losses, toggle_grads, in_channels, out_channels,
-                 bands, down_samples, gen_lr, dis_lr, beta1, beta2, adam_eps, save_path, device):
+                 bands, down_samples, gen_lr, dis_lr, beta1, beta2, adam_eps, save_path, device, rank=0, world_size=1,
+                 cuda_graphs=False, compile_models=False, accum_steps=1):
         self.batch_size = batch_size
         self.latent_dim = latent_dim
         self.num_classes = num_classes
@@ -30,9 +121,18 @@ class LCGAN:
         self.epochs = epochs
         self.ema_losses = ema_losses
         self.toggle_grads = toggle_grads
-        self.writer = SummaryWriter(save_path)
+        self.accum_steps = accum_steps
+        self.accum_counter = 0
+        self.rank = rank
+        self.local_rank = local_rank(rank)
+        self.world_size = world_size
+        self.writer = SummaryWriter(save_path) if rank == 0 else None
         self.save_path = save_path
         self.device = device
+        self.use_amp = device == 'cuda' and torch.cuda.is_available()
+        # graph replays overwrite their static grad buffers, so graphs are not used with gradient accumulation
+        self.cuda_graphs = cuda_graphs and self.use_amp and world_size == 1 and accum_steps == 1
+        self.compile_models = compile_models and not self.cuda_graphs
 
         # ----------------- encoder & decoder ----------------- #
 
@@ -52,33 +152,48 @@ class LCGAN:
         self.discriminator = self.build_discriminator(in_channels['dis'], out_channels['dis'], down_samples,
                                                       num_classes, dis_lr, beta1, beta2, adam_eps)
 
+        if device == 'cuda' and torch.cuda.is_available():
+            self.encoder.to(device)
+            self.decoder.to(device)
+            self.generator.to(device)
+            self.discriminator.to(device)
+            print('Using GPU')
+
+            # NHWC lets cuDNN pick the tensor-core conv kernels; input shapes are fixed so autotuning is safe
+            for model in [self.encoder, self.decoder, self.generator, self.discriminator]:
+                model.to(memory_format=torch.channels_last)
+            torch.backends.cudnn.benchmark = True
+
+            # the encoder/decoder are frozen, so bf16 halves their bandwidth without affecting training
+            if torch.cuda.is_bf16_supported():
+                self.encoder.to(torch.bfloat16)
+                self.decoder.to(torch.bfloat16)
+
+        if self.cuda_graphs:
+            self.graph_networks()
+
         self.gan = self.build_gan()
 
+        self.scaler_d = torch.cuda.amp.GradScaler(enabled=self.use_amp)
+        self.scaler_g = torch.cuda.amp.GradScaler(enabled=self.use_amp)
+
         compare = True if num_classes == 2 else False
         self.z, self.y = self.init_random_samples(compare=compare)
-        self.fixed_z, self.fixed_y = self.init_random_samples(compare=compare)
 
-        self.fixed_z.sample_()
-        self.fixed_y.sample_()
+        # the fixed samples are drawn once and never resampled, so plain tensors are enough
+        fixed_z, fixed_y = self.init_random_samples(compare=compare)
+        fixed_z.sample_()
+        fixed_y.sample_()
+        self.fixed_z, self.fixed_y = fixed_z.as_subclass(torch.Tensor), fixed_y.as_subclass(torch.Tensor)
 
         self.cs = ColourSystem(cs='sRGB', start=400, end=720, num=bands, device=device)
 
-        if device == 'cuda' and torch.cuda.is_available():
-            self.encoder.to(device)
-            self.decoder.to(device)
-            self.generator.to(device)
-            self.discriminator.to(device)
-            self.gan.to(device)
-            print('Using GPU')
-
     def init_random_samples(self, compare=False):
-        z = Distribution(torch.randn(self.batch_size['gen'], self.latent_dim, requires_grad=False))
+        z = torch.randn(self.batch_size['gen'], self.latent_dim, device=self.device).as_subclass(Distribution)
         z.init_distribution('normal', mean=0.0, var=1.0)
-        z = z.to(self.device, torch.float32)
 
-        y = Distribution(torch.zeros(self.batch_size['gen'], requires_grad=False))
+        y = torch.zeros(self.batch_size['gen'], dtype=torch.int64, device=self.device).as_subclass(Distribution)
         y.init_distribution('comparison' if compare else 'categorical', num_categories=self.num_classes)
-        y = y.to(self.device, torch.int64)
 
         return z, y
 
@@ -119,34 +234,76 @@ class LCGAN:
             nn.ReLU(True)
         )
 
+    def graph_networks(self):
+        batch_size = self.batch_size['gen']
+        spatial_size = 4 * 2 ** len(self.generator.blocks)
+        latent_channels = self.generator.output[-1].out_channels
+
+        z = torch.randn(batch_size, self.latent_dim, device=self.device)
+        y = torch.randint(0, self.num_classes, (batch_size,), device=self.device)
+        x = torch.randn(2 * batch_size, latent_channels, spatial_size, spatial_size, device=self.device)
+        x = x.to(memory_format=torch.channels_last)
+        dy = torch.randint(0, self.num_classes, (2 * batch_size,), device=self.device)
+
+        # capture under the same autocast state used by train_step (graphs require cache_enabled=False)
+        with torch.autocast('cuda', dtype=torch.float16, cache_enabled=False):
+            self.generator = graph_module(self.generator, (z, y))
+            self.discriminator = graph_module(self.discriminator, (x, dy))
+            check_graph_accumulation(self.discriminator, (x, dy))
+
+        # warmup/capture backward passes leave gradients behind
+        self.generator.optim.zero_grad()
+        self.discriminator.optim.zero_grad()
+
     def build_gan(self):
-        return GAN(self.generator, self.discriminator, self.encoder, self.decoder)
+        generator, discriminator = self.generator, self.discriminator
+
+        # only the trainable networks need gradient sync; the frozen encoder/decoder stay unwrapped
+        if self.world_size > 1:
+            generator = DDP(generator, device_ids=[self.local_rank], broadcast_buffers=False, bucket_cap_mb=25)
+            discriminator = DDP(discriminator, device_ids=[self.local_rank], broadcast_buffers=False, bucket_cap_mb=25,
+                                find_unused_parameters=self.toggle_grads or self.accum_steps > 1)
+
+        # compile on top of DDP; LCGAN keeps the plain modules so checkpoint keys are unchanged
+        if self.compile_models:
+            generator = torch.compile(generator, mode='max-autotune', fullgraph=False)
+            discriminator = torch.compile(discriminator, mode='max-autotune', fullgraph=False)
+
+        return GAN(generator, discriminator, self.encoder, self.decoder)
+
+    def precompute_latents(self, data_loader):
+        # the encoder is frozen, so its outputs can be computed once and reused every epoch;
+        # note that any random augmentation done by the dataset is frozen as well
+        self.encoder.eval()
+
+        latents, labels = [], []
+        with torch.no_grad(), torch.autocast('cuda', dtype=torch.float16, enabled=self.use_amp), \
+                frozen_autocast(self.encoder):
+            for x, y in tqdm(data_loader, disable=self.rank != 0):
+                x = x.to(self.device, self.encoder[0].weight.dtype)
+                latents.append(self.encoder(x).half().cpu())
+                labels.append(y)
+
+        dataset = TensorDataset(torch.cat(latents, dim=0), torch.cat(labels, dim=0))
+        return DataLoader(dataset, batch_size=data_loader.batch_size, shuffle=True, pin_memory=data_loader.pin_memory,
+                          drop_last=data_loader.drop_last)
 
     def save_images(self, epoch):
-        if epoch == 300:
-            Path(self.save_path + '/images').mkdir(parents=True, exist_ok=True)
+        Path(self.save_path + '/images').mkdir(parents=True, exist_ok=True)
 
         self.generator.eval()
         self.decoder.eval()
 
-        generated_images = self.generator(self.fixed_z, self.fixed_y)
-        generated_images = self.decoder(generated_images)
-
-        generated_images = generated_images.detach().cpu().numpy()
-        generated_images = np.transpose(generated_images, (0, 2, 3, 1))
+        with torch.no_grad():
+            generated_images = self.generator(self.fixed_z, self.fixed_y)
+            generated_images = self.decoder(generated_images.to(self.decoder[0].weight.dtype))[:16].float()
 
-        if generated_images.shape[1] > 3:
-            generated_images = self.cs.spec_to_rgb(generated_images)
+            if generated_images.shape[1] > 3:
+                generated_images = self.cs.spec_to_rgb_torch(generated_images)
 
-        plt.figure(figsize=(20, 20))
+            grid = make_grid(generated_images, nrow=4, normalize=True, value_range=(-1, 1))
 
-        for i in range(16):
-            plt.subplot(4, 4, i + 1)
-            plt.imshow(generated_images[i] * 0.5 + 0.5)
-            plt.axis('off')
-
-        plt.savefig('{}/images/generated_{:04d}.png'.format(self.save_path, epoch))
-        plt.close()
+        save_image(grid, '{}/images/generated_{:04d}.png'.format(self.save_path, epoch))
 
     # ---------------- Define training loop ---------------- #
 
@@ -154,18 +311,42 @@ class LCGAN:
         for param in model.parameters():
             param.requires_grad = activate
 
-    def train(self, data_loader, epochs):
+    def sync_context(self, model, sync):
+        # skip the DDP all-reduce on intermediate accumulation steps
+        if sync or self.world_size == 1:
+            return nullcontext()
+        return model.no_sync()
+
+    def train(self, data_loader, epochs, precompute_latents=False, save_every=1):
+        if precompute_latents:
+            data_loader = self.precompute_latents(data_loader)
+
+        sampler = None
+        if self.world_size > 1:
+            sampler = DistributedSampler(data_loader.dataset, num_replicas=self.world_size, rank=self.rank)
+            data_loader = DataLoader(data_loader.dataset, batch_size=data_loader.batch_size, sampler=sampler,
+                                     num_workers=data_loader.num_workers, pin_memory=data_loader.pin_memory,
+                                     drop_last=data_loader.drop_last, collate_fn=data_loader.collate_fn,
+                                     persistent_workers=data_loader.num_workers > 0)
+
         for epoch in range(300, epochs + 300):
+            if sampler is not None:
+                sampler.set_epoch(epoch)
+
             accuracy_metrics = {}
             accuracy_iterations = 0
 
-            loop = tqdm(enumerate(data_loader), total=len(data_loader))
+            loop = tqdm(enumerate(data_loader), total=len(data_loader), disable=self.rank != 0)
             for iter, (x, y) in loop:
                 self.generator.train()
                 self.discriminator.train()
 
-                x, y = x.to(self.device), y[:, 0].to(self.device, torch.int64)
-                metrics = self.train_step(x, y, iter)
+                if y.dim() > 1:
+                    y = y[:, 0]
+
+                x = x.to(self.device, torch.float32, non_blocking=True)
+                y = y.to(self.device, torch.int64, non_blocking=True)
+                metrics = self.train_step(x, y, iter, encoded=precompute_latents)
 
                 for k, v in metrics.items():
                     if k not in accuracy_metrics:
@@ -173,98 +354,135 @@ class LCGAN:
                     accuracy_metrics[k] += v
 
                 accuracy_iterations += 1
-                loop.set_postfix(**metrics)
+
+                # metrics stay on the device; only sync for the progress bar every few iterations
+                if iter % _POSTFIX_EVERY_ITERS == 0:
+                    loop.set_postfix(**dict(zip(metrics.keys(), torch.stack(list(metrics.values())).tolist())))
 
             # ---------------- Log metrics ---------------- #
 
             if self.writer:
                 for k, v in accuracy_metrics.items():
-                    self.writer.add_scalar('train_{}'.format(k), v / accuracy_iterations, epoch)
+                    self.writer.add_scalar('train_{}'.format(k), (v / accuracy_iterations).item(), epoch)
+
+            if self.rank != 0:
+                continue
 
-            self.save_images(epoch)
+            if int(epoch) % save_every == 0:
+                self.save_images(epoch)
 
             if int(epoch) % 25 == 0:
                 self.save_checkpoint(self.save_path, epoch=epoch)
                 print(f'saved checkpoint at epoch {epoch}')
 
-    def train_step(self, inputs, labels, iter):
+    def train_step(self, inputs, labels, iter, encoded=False):
 
         # ----------------- Discriminator loss ----------------- #
 
-        self.generator.optim.zero_grad()
-        self.discriminator.optim.zero_grad()
+        # gradients are accumulated over accum_steps calls and applied on the last one
+        first_step = self.accum_counter % self.accum_steps == 0
+        self.accum_counter += 1
+        last_step = self.accum_counter % self.accum_steps == 0
+
+        if first_step:
+            self.generator.optim.zero_grad(set_to_none=True)
+            self.discriminator.optim.zero_grad(set_to_none=True)
+
+        # only split into micro-batches when the loader batch is larger than the generator batch
+        if inputs.size(0) > self.batch_size['gen']:
+            inputs = torch.split(inputs, self.batch_size['gen'])
+            labels = torch.split(labels, self.batch_size['gen'])
+        else:
+            inputs, labels = [inputs], [labels]
+
+        num_accum = len(inputs)
 
-        inputs = torch.split(inputs, self.batch_size['gen'])
-        labels = torch.split(labels, self.batch_size['gen'])
+        # D micro-batches accumulate into the same grads, which a graph replay per micro-batch would overwrite
+        if self.cuda_graphs:
+            self.discriminator.replay_graph = num_accum == 1
 
-        counter = 0
+        # when accumulating, the generator pass must not leave gradients on the discriminator
+        toggle_grads = self.toggle_grads or self.accum_steps > 1
 
-        if self.toggle_grads:
+        if toggle_grads:
             self.toggle_grad(self.generator, activate=False)
             self.toggle_grad(self.discriminator, activate=True)
 
-        for x, y in zip(inputs, labels):
-            self.discriminator.optim.zero_grad()
-
-            counter = 0
-            discriminator_loss_real_total = 0
-            discriminator_loss_fake_total = 0
-            discriminator_real_total = 0
-            discriminator_fake_total = 0
+        discriminator_loss_real_total = 0
+        discriminator_loss_fake_total = 0
+        discriminator_real_total = 0
+        discriminator_fake_total = 0
 
+        for i, (x, y) in enumerate(zip(inputs, labels)):
             self.z.sample_()
             self.y.sample_()
 
-            x.requires_grad = True
-            discriminator_scores = self.gan(self.z[:self.batch_size['gen']], self.y[:self.batch_size['gen']], x, y,
-                                            cs=None, train_generator=False, policy='')
-            discriminator_fake, discriminator_real = discriminator_scores
+            x.requires_grad = not encoded
+            with self.sync_context(self.gan.discriminator, last_step and i == num_accum - 1):
+                with torch.autocast('cuda', dtype=torch.float16, enabled=self.use_amp,
+                                    cache_enabled=not self.cuda_graphs):
+                    discriminator_scores = self.gan(self.z[:self.batch_size['gen']], self.y[:self.batch_size['gen']],
+                                                    x, y, cs=None, train_generator=False, policy='', encoded=encoded)
+                    discriminator_fake, discriminator_real = discriminator_scores
 
-            # discriminator loss
+                    # discriminator loss
 
-            discriminator_loss_real, discriminator_loss_fake = loss_hinge_dis(discriminator_fake, discriminator_real,
-                                                                              self.ema_losses, iter)
+                    discriminator_loss_real, discriminator_loss_fake = loss_hinge_dis(discriminator_fake,
+                                                                                      discriminator_real,
+                                                                                      self.ema_losses, iter)
 
-            discriminator_loss = discriminator_loss_real + discriminator_loss_fake
-            discriminator_loss.backward()
+                    discriminator_loss = discriminator_loss_real + discriminator_loss_fake
+
+                self.scaler_d.scale(discriminator_loss / (num_accum * self.accum_steps)).backward()
 
             # accumulated discriminator losses
 
-            discriminator_loss_real_total += discriminator_loss_real.item()
-            discriminator_loss_fake_total += discriminator_loss_fake.item()
-            discriminator_real_total += torch.mean(discriminator_real).item()
-            discriminator_fake_total += torch.mean(discriminator_fake).item()
+            discriminator_loss_real_total += discriminator_loss_real.detach().float() / num_accum
+            discriminator_loss_fake_total += discriminator_loss_fake.detach().float() / num_accum
+            discriminator_real_total += torch.mean(discriminator_real.detach().float()) / num_accum
+            discriminator_fake_total += torch.mean(discriminator_fake.detach().float()) / num_accum
 
-            self.discriminator.optim.step()
+        if last_step:
+            self.scaler_d.step(self.discriminator.optim)
+            self.scaler_d.update()
 
         # ----------------- Generator loss ----------------- #
 
-        if self.toggle_grads:
+        if toggle_grads:
             self.toggle_grad(self.generator, activate=True)
             self.toggle_grad(self.discriminator, activate=False)
 
-        self.generator.optim.zero_grad()
+        if first_step:
+            self.generator.optim.zero_grad(set_to_none=True)
 
         generator_loss_total = 0
 
         self.z.sample_()
         self.y.sample_()
-        discriminator_fake = self.gan(self.z, self.y, cs=None, train_generator=True, policy='')
-        generator_loss = loss_hinge_gen(discriminator_fake, discriminator_real_total)
-        generator_loss.backward()
+        # the discriminator is frozen during this pass when toggling grads, so it has nothing to all-reduce
+        with self.sync_context(self.gan.generator, last_step), \
+                self.sync_context(self.gan.discriminator, not toggle_grads):
+            with torch.autocast('cuda', dtype=torch.float16, enabled=self.use_amp,
+                                cache_enabled=not self.cuda_graphs):
+                discriminator_fake = self.gan(self.z, self.y, cs=None, train_generator=True, policy='')
+                generator_loss = loss_hinge_gen(discriminator_fake, discriminator_real_total)
+
+            self.scaler_g.scale(generator_loss / self.accum_steps).backward()
 
         # accumulated generator losses
 
-        generator_loss_total += generator_loss.item()
+        generator_loss_total += generator_loss.detach().float()
         self.ema_losses.update(generator_loss_total, 'generator_loss', iter)
 
-        self.generator.optim.step()
+        if last_step:
+            self.scaler_g.step(self.generator.optim)
+            self.scaler_g.update()
 
-        outputs = dict(gen_loss=float(generator_loss_total),
-                       dis_loss_real=float(discriminator_loss_real_total),
-                       dis_loss_fake=float(discriminator_loss_fake_total),
-                       dis_real=float(discriminator_real_total),
-                       dis_fake=float(discriminator_fake_total))
+        outputs = dict(gen_loss=generator_loss_total,
+                       dis_loss_real=discriminator_loss_real_total,
+                       dis_loss_fake=discriminator_loss_fake_total,
+                       dis_real=discriminator_real_total,
+                       dis_fake=discriminator_fake_total)
 
         return outputs
 
@@ -278,68 +496,70 @@ class LCGAN:
 
     def load_checkpoint(self, path, epoch=None):
         if epoch is None:
-            self.generator.load_state_dict(torch.load('{}/generator.pth'.format(path)))
-            self.discriminator.load_state_dict(torch.load('{}/discriminator.pth'.format(path)))
+            self.generator.load_state_dict(load_weights('{}/generator.pth'.format(path)))
+            self.discriminator.load_state_dict(load_weights('{}/discriminator.pth'.format(path)))
         else:
-            self.generator.load_state_dict(torch.load('{}/generator_{}.pth'.format(path, epoch)))
-            self.discriminator.load_state_dict(torch.load('{}/discriminator_{}.pth'.format(path, epoch)))
+            self.generator.load_state_dict(load_weights('{}/generator_{}.pth'.format(path, epoch)))
+            self.discriminator.load_state_dict(load_weights('{}/discriminator_{}.pth'.format(path, epoch)))
 
 
     def save_ae_checkpoint(self, path, epoch=None):
+        # store fp32 weights even if the frozen networks run in bf16
+        encoder_state = {k: v.float() for k, v in self.encoder.state_dict().items()}
+        decoder_state = {k: v.float() for k, v in self.decoder.state_dict().items()}
+
         if epoch is None:
-            torch.save(self.encoder.state_dict(), '{}/encoder.pth'.format(path))
-            torch.save(self.decoder.state_dict(), '{}/decoder.pth'.format(path))
+            torch.save(encoder_state, '{}/encoder.pth'.format(path))
+            torch.save(decoder_state, '{}/decoder.pth'.format(path))
         else:
-            torch.save(self.encoder.state_dict(), '{}/encoder_{}.pth'.format(path, epoch))
-            torch.save(self.decoder.state_dict(), '{}/decoder_{}.pth'.format(path, epoch))
+            torch.save(encoder_state, '{}/encoder_{}.pth'.format(path, epoch))
+            torch.save(decoder_state, '{}/decoder_{}.pth'.format(path, epoch))
 
     def load_ae_checkpoint(self, path, epoch=None):
         if epoch is None:
-            self.encoder.load_state_dict(torch.load('{}/encoder.pth'.format(path)))
-            self.decoder.load_state_dict(torch.load('{}/decoder.pth'.format(path)))
+            self.encoder.load_state_dict(load_weights('{}/encoder.pth'.format(path)))
+            self.decoder.load_state_dict(load_weights('{}/decoder.pth'.format(path)))
         else:
-            self.encoder.load_state_dict(torch.load('{}/encoder_{}.pth'.format(path, epoch)))
-            self.decoder.load_state_dict(torch.load('{}/decoder_{}.pth'.format(path, epoch)))
+            self.encoder.load_state_dict(load_weights('{}/encoder_{}.pth'.format(path, epoch)))
+            self.decoder.load_state_dict(load_weights('{}/decoder_{}.pth'.format(path, epoch)))
 
 
 # ---------------- Define functions and models ---------------- #
 
 class Distribution(torch.Tensor):
+    # results of ops on a Distribution are plain tensors, so the subclass does not leak into the networks
+    __torch_function__ = torch._C._disabled_torch_function_impl
+
     def init_distribution(self, dist_type, **kwargs):
         self.dist_type = dist_type
         self.dist_kwargs = kwargs
 
+        # bind the sampler once so sample_() does not branch on dist_type every iteration
         if self.dist_type == 'normal':
             self.mean, self.var = kwargs['mean'], kwargs['var']
-        elif self.dist_type == 'categorical' or self.dist_type == 'comparison':
+            self._sample = partial(self.normal_, self.mean, self.var)
+        elif self.dist_type == 'categorical':
             self.num_categories = kwargs['num_categories']
+            self._sample = partial(self.random_, 0, self.num_categories)
+        elif self.dist_type == 'comparison':
+            self.num_categories = kwargs['num_categories']
+            self._sample = self.zero_
         else:
             raise ValueError('Distribution type not recognized')
 
     def sample_(self):
-        if self.dist_type == 'normal':
-            self.normal_(self.mean, self.var)
-
-        elif self.dist_type == 'categorical':
-            self.random_(0, self.num_categories)
-
-        elif self.dist_type == 'comparison':
-            self.zero_()
-
-    # Silly hack: overwrite the .to() method to wrap the new object
-    # in a distribution as well
-    def to(self, *args, **kwargs):
-        new_obj = Distribution(self)
-        try:
-            new_obj.init_distribution(self.dist_type, **self.dist_kwargs)
-        except:
-            pass
-        new_obj.data = super().to(*args, **kwargs)
-        return new_obj
+        self._sample()
 
 
 # ---------------- Generator ---------------- #
 
+WEIGHT_INITS = {
+    'ortho': nn.init.orthogonal_,
+    'N02': partial(nn.init.normal_, mean=0, std=0.02),
+    'glorot': nn.init.xavier_uniform_,
+    'xavier': nn.init.xavier_uniform_,
+}
+
 
 class Generator(nn.Module):
     def __init__(self, in_channels, out_channels, num_classes, latent_dim, bands, lr=0.00005, beta1=0.5, beta2=0.999,
@@ -369,27 +589,27 @@ class Generator(nn.Module):
 
     def init_weights(self):
         self.param_count = 0
+        init_fn = WEIGHT_INITS.get(self.init)
+        if init_fn is None:
+            print('Init style not recognized...')
+
         for module in self.modules():
-            if isinstance(module, nn.Conv2d) or isinstance(module, nn.Linear) or isinstance(module, nn.Embedding):
-                if self.init == 'ortho':
-                    nn.init.orthogonal_(module.weight)
-                elif self.init == 'N02':
-                    nn.init.normal_(module.weight, 0, 0.02)
-                elif self.init in ['glorot', 'xavier']:
-                    nn.init.xavier_uniform_(module.weight)
-                else:
-                    print('Init style not recognized...')
-                self.param_count += sum([p.data.nelement() for p in module.parameters()])
+            if isinstance(module, (nn.Conv2d, nn.Linear, nn.Embedding)):
+                if init_fn is not None:
+                    init_fn(module.weight)
+
+                self.param_count += module.weight.numel()
+                if getattr(module, 'bias', None) is not None:
+                    self.param_count += module.bias.numel()
         print('Param count for G''s initialized parameters: %d' % self.param_count)
 
     def forward(self, z, y):
-        ys = [y] * len(self.blocks)
-
         h = self.linear(z)
         h = h.view(h.size(0), -1, 4, 4)
 
-        for i, block in enumerate(self.blocks):
-            h = block(h, ys[i])
+        # every block is conditioned on the same class vector
+        for block in self.blocks:
+            h = block(h, y)
 
         return torch.tanh(self.output(h))
 
@@ -425,17 +645,18 @@ class Discriminator(nn.Module):
 
     def init_weights(self):
         self.param_count = 0
+        init_fn = WEIGHT_INITS.get(self.init)
+        if init_fn is None:
+            print('Init style not recognized...')
+
         for module in self.modules():
-            if isinstance(module, nn.Conv2d) or isinstance(module, nn.Linear) or isinstance(module, nn.Embedding):
-                if self.init == 'ortho':
-                    nn.init.orthogonal_(module.weight)
-                elif self.init == 'N02':
-                    nn.init.normal_(module.weight, 0, 0.02)
-                elif self.init in ['glorot', 'xavier']:
-                    nn.init.xavier_uniform_(module.weight)
-                else:
-                    print('Init style not recognized...')
-                self.param_count += sum([p.data.nelement() for p in module.parameters()])
+            if isinstance(module, (nn.Conv2d, nn.Linear, nn.Embedding)):
+                if init_fn is not None:
+                    init_fn(module.weight)
+
+                self.param_count += module.weight.numel()
+                if getattr(module, 'bias', None) is not None:
+                    self.param_count += module.bias.numel()
         print('Param count for D''s initialized parameters: %d' % self.param_count)
 
     def forward(self, x, y):
@@ -443,9 +664,11 @@ class Discriminator(nn.Module):
         for i, block in enumerate(self.blocks):
             h = block(h)
 
-        h = torch.sum(self.activation(h), dim=[2, 3])
-        output = self.linear(h)
-        output += torch.sum(self.embedding(y) * h, 1, keepdim=True)
+        # spatial sum computed as an average pool (NHWC-friendly) rescaled by the number of pixels;
+        # upcast like torch.sum does under autocast so the rescale cannot overflow in fp16
+        h = self.activation(h)
+        h = F.adaptive_avg_pool2d(h, 1).flatten(1).float() * (h.size(2) * h.size(3))
+        output = self.linear(h) + torch.sum(self.embedding(y) * h, 1, keepdim=True)
 
         return output
 
@@ -457,21 +680,53 @@ class GAN(nn.Module):
         self.discriminator = discriminator
         self.encoder = encoder
         self.decoder = decoder
+        self._aug = DiffAugmentRunner()
+
+        # persistent discriminator input for the real/fake pass, filled in place instead of torch.cat
+        self._disc_input = None
+        self._disc_classes = None
+
+    def discriminator_buffers(self, generated, latent_x, gy, dy):
+        shape = (generated.size(0) + latent_x.size(0),) + tuple(generated.shape[1:])
+        dtype = torch.promote_types(generated.dtype, latent_x.dtype)
+
+        if self._disc_input is None or self._disc_input.shape != shape or self._disc_input.dtype != dtype \
+                or self._disc_input.device != generated.device:
+            self._disc_input = torch.empty(shape, dtype=dtype, device=generated.device,
+                                           memory_format=torch.channels_last)
+            self._disc_classes = torch.empty(shape[0], dtype=gy.dtype, device=gy.device)
 
-    def forward(self, z, gy, x=None, dy=None, cs=None, train_generator=False, only_gz=False, policy=False):
+        batch_size = generated.size(0)
+        self._disc_input[:batch_size].copy_(generated)
+        self._disc_input[batch_size:].copy_(latent_x)
+        self._disc_classes[:batch_size].copy_(gy)
+        self._disc_classes[batch_size:].copy_(dy)
+
+        return self._disc_input, self._disc_classes
+
+    def forward(self, z, gy, x=None, dy=None, cs=None, train_generator=False, only_gz=False, policy=False,
+                encoded=False):
         latent_x = x
-        if x is not None:
-            with torch.no_grad():
-                latent_x = self.encoder(x)
+        if x is not None and not encoded:
+            with torch.no_grad(), frozen_autocast(self.encoder):
+                latent_x = self.encoder(x.to(self.encoder[0].weight.dtype)).float()
 
         with torch.set_grad_enabled(train_generator):
             generated = self.generator(z, gy)
             if cs is not None:
-                generated = cs.spec_to_rgb_torch(generated)
+                # keep the colour transform in fp32 when running under autocast
+                with torch.autocast('cuda', enabled=False):
+                    generated = cs.spec_to_rgb_torch(generated.float())
+
+        # the buffer is only reused when nothing requires grad, otherwise the copies would chain autograd history
+        if latent_x is not None and not generated.requires_grad and not latent_x.requires_grad:
+            discriminator_input, discriminator_classes = self.discriminator_buffers(generated, latent_x, gy, dy)
+        else:
+            discriminator_input = torch.cat([img for img in [generated, latent_x] if img is not None], dim=0)
+            discriminator_classes = torch.cat([label for label in [gy, dy] if label is not None], dim=0)
 
-        discriminator_input = torch.cat([img for img in [generated, latent_x] if img is not None], dim=0)
-        discriminator_input = DiffAugment(discriminator_input, policy=policy)
-        discriminator_classes = torch.cat([label for label in [gy, dy] if label is not None], dim=0)
+        discriminator_input = self._aug(discriminator_input, policy=policy)
+        discriminator_input = discriminator_input.to(memory_format=torch.channels_last)
 
         discriminator_target = self.discriminator(discriminator_input, discriminator_classes)
 
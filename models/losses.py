@@ -67,8 +67,9 @@ def loss_rahinge_gen(dis_fake, dis_real):
 def loss_hinge_dis(dis_fake, dis_real, ema=None, it=None):
     if ema is not None:
         # track the prediction
-        ema.update(torch.mean(dis_fake).item(), 'D_fake', it)
-        ema.update(torch.mean(dis_real).item(), 'D_real', it)
+        # detached tensors instead of .item() so tracking does not force a device sync
+        ema.update(torch.mean(dis_fake).detach(), 'D_fake', it)
+        ema.update(torch.mean(dis_real).detach(), 'D_real', it)
 
     loss_real = F.relu(1. - dis_real)
     loss_fake = F.relu(1. + dis_fake)
@@ -1,3 +1,5 @@
+from typing import Tuple
+
 import torch
 from torch import nn
 
@@ -19,31 +21,52 @@ def gram_schmidt(x, ys):
     return x
 
 
-# Apply num_itrs steps of the power method to estimate top N singular values.
-
-def power_iteration(W, u_, update=True, eps=1e-12):
-    # Lists holding singular vectors and values
-    us, vs, svs = [], [], []
-    for i, u in enumerate(u_):
-        # Run one step of the power iteration
-        with torch.no_grad():
-            v = torch.matmul(u, W)
-            # Run Gram-Schmidt to subtract components of all other singular vectors
-            v = F.normalize(gram_schmidt(v, vs), eps=eps)
-            # Add to the list
-            vs += [v]
-            # Update the other singular vector
-            u = torch.matmul(v, W.t())
-            # Run Gram-Schmidt to subtract components of all other singular vectors
-            u = F.normalize(gram_schmidt(u, us), eps=eps)
-            # Add to the list
-            us += [u]
-            if update:
-                u_[i][:] = u
-        # Compute this singular value and add it to the list
-        svs += [torch.squeeze(torch.matmul(torch.matmul(v, W.t()), u.t()))]
-        # svs += [torch.sum(F.linear(u, W.transpose(0, 1)) * v)]
-    return svs, us, vs
+# Orthonormalize the rows of X in order. For several vectors a single QR replaces the sequential
+# Gram-Schmidt passes; the signs are flipped to match Gram-Schmidt's positive diagonal.
+# A single row is normalized in place, so X must be a scratch tensor (e.g. a fresh matmul output).
+
+@torch.jit.script
+def orthonormalize(X: torch.Tensor, eps: float = 1e-12) -> torch.Tensor:
+    if X.size(0) == 1:
+        # TorchScript binds straight to the aten schemas, so the norm order has to be passed explicitly
+        return X.div_(torch.linalg.vector_norm(X, 2.0, [1], True).clamp_min(eps))
+
+    Q, R = torch.linalg.qr(X.t().float())
+    Q = torch.where(torch.diagonal(R) < 0, -Q, Q)
+    return Q.t().to(X.dtype)
+
+
+# One step of the power method on the stacked singular vectors, scripted to skip per-op Python dispatch
+
+@torch.jit.script
+def _power_iter(W: torch.Tensor, Wt: torch.Tensor, U: torch.Tensor, eps: float) -> Tuple[torch.Tensor, torch.Tensor]:
+    V = orthonormalize(torch.matmul(U, W), eps)
+    U = orthonormalize(torch.matmul(V, Wt), eps)
+    return U, V
+
+
+# Apply num_itrs steps of the power method to estimate top N singular values, for all of them at once.
+# Wt is W.t(), passed in so callers can materialize the transpose once.
+
+def power_iteration(W, Wt, u_, num_itrs=1, update=True, eps=1e-12):
+    with torch.no_grad():
+        # u_ holds the singular vectors (u side) as a (num_svs, N) matrix; run the power steps on all
+        # of them, orthogonalizing the singular vectors against each other
+        U = u_
+        # Without update the u buffers never advance, so extra steps would repeat the first one
+        for _ in range(num_itrs if update else 1):
+            U, V = _power_iter(W, Wt, U, eps)
+        if update:
+            u_.copy_(U)
+    # Compute the singular values once, on the final vectors (outside no_grad, the gradient flows through W)
+    svs = torch.einsum('ij,ij->i', torch.matmul(V, Wt), U)
+    return svs, U, V
+
+
+# Python-side caches must not be baked into a captured CUDA graph or a compiled graph
+
+def _is_capturing(weight):
+    return (weight.is_cuda and torch.cuda.is_current_stream_capturing()) or torch.compiler.is_compiling()
 
 
 # Spectral normalization base class
@@ -55,36 +78,82 @@ class SN(object):
         self.transpose = transpose
         self.eps = eps
 
-        # Register a singular vector for each sv
-        for i in range(self.num_svs):
-            self.register_buffer('u%d' % i, torch.randn(1, num_outputs))
-            self.register_buffer('sv%d' % i, torch.ones(1))
+        # Register the singular vectors and values, one row / entry per sv
+        self.register_buffer('u_buf', torch.randn(self.num_svs, num_outputs))
+        self.register_buffer('sv_buf', torch.ones(self.num_svs))
+        self._register_load_state_dict_pre_hook(self._load_legacy_buffers)
+
+        # Normalized weight reused across eval forwards, see W_()
+        self._cached_W = None
+        self._cached_key = None
 
-    # Singular vectors (u side)
+        # Singular vectors reused by training forwards that share an optimizer step, see W_()
+        self._last_vectors = None
+        self._last_w_key = None
+
+    # Singular vectors (u side), (num_svs, N)
     @property
     def u(self):
-        return [getattr(self, 'u%d' % i) for i in range(self.num_svs)]
+        return self.u_buf
 
     # Singular values;
     # note that these buffers are just for logging and are not used in training.
     @property
     def sv(self):
-        return [getattr(self, 'sv%d' % i) for i in range(self.num_svs)]
+        return self.sv_buf
+
+    # Checkpoints saved before the buffers were merged store one u%d / sv%d buffer per sv
+    def _load_legacy_buffers(self, state_dict, prefix, *args):
+        for name, legacy in (('u_buf', 'u%d'), ('sv_buf', 'sv%d')):
+            keys = [prefix + legacy % i for i in range(self.num_svs)]
+            if prefix + name not in state_dict and all(k in state_dict for k in keys):
+                state_dict[prefix + name] = torch.cat([state_dict.pop(k) for k in keys], dim=0)
 
     # Compute the spectrally-normalized weight
     def W_(self):
-        W_mat = self.weight.view(self.weight.size(0), -1)
+        # In eval mode without autograd the result only changes when the weight or the u buffers do
+        capturing = _is_capturing(self.weight)
+        use_cache = not self.training and not torch.is_grad_enabled() and not capturing
+        if use_cache:
+            cache_key = (self.weight.data_ptr(), self.weight._version, self.u._version)
+            if self._cached_W is not None and self._cached_key == cache_key:
+                return self._cached_W
+        else:
+            self._cached_W = None
+
+        # Flatten to (out, -1). Channels-last conv weights are flattened as (out, kh, kw, in), which is
+        # a free view; permuting the columns does not change the singular values or u
+        if self.weight.dim() == 4 and self.weight.is_contiguous(memory_format=torch.channels_last):
+            W_mat = self.weight.permute(0, 2, 3, 1).reshape(self.weight.size(0), -1)
+        else:
+            W_mat = self.weight.view(self.weight.size(0), -1)
         if self.transpose:
             W_mat = W_mat.t()
-        # Apply num_itrs power iterations
-        for _ in range(self.num_itrs):
-            svs, us, vs = power_iteration(W_mat, self.u, update=self.training, eps=self.eps)
+        # The transpose feeds every power step; make it contiguous only when it is reused
+        Wt_mat = W_mat.t()
+        if self.num_svs * self.num_itrs > 1:
+            Wt_mat = Wt_mat.contiguous()
+        # While the weight is unchanged (e.g. generator forwards in the D and G passes of one step),
+        # reuse the singular vectors and only recompute the differentiable singular values. The key is only
+        # read outside capture: data_ptr()/_version would graph-break torch.compile in every SN layer
+        w_key = (self.weight.data_ptr(), self.weight._version) if self.training and not capturing else None
+        if w_key is not None and self._last_vectors is not None and self._last_w_key == w_key:
+            us, vs = self._last_vectors
+            svs = torch.einsum('ij,ij->i', torch.matmul(vs, Wt_mat), us)
+        else:
+            # Apply num_itrs power iterations
+            svs, us, vs = power_iteration(W_mat, Wt_mat, self.u, self.num_itrs, update=self.training, eps=self.eps)
+            if w_key is not None:
+                self._last_vectors, self._last_w_key = (us, vs), w_key
         # Update the svs
         if self.training:
             with torch.no_grad():  # Make sure to do this in a no_grad() context or you'll get memory leaks!
-                for i, sv in enumerate(svs):
-                    self.sv[i][:] = sv
-        return self.weight / svs[0]
+                self.sv.copy_(svs)
+        # Scalar reciprocal then multiply; the gradient still flows through svs[0] in training
+        W = self.weight * svs[0].reciprocal()
+        if use_cache:
+            self._cached_W, self._cached_key = W, cache_key
+        return W
 
 
 # 2D Conv layer with spectral norm
@@ -190,7 +259,7 @@ class CCBN(nn.Module):
     def forward(self, x, y):
         # Calculate class-conditional gains and biases
 
-        gain = (1 + self.gain(y)).view(y.size(0), -1, 1, 1)
+        gain = self.gain(y).add_(1.).view(y.size(0), -1, 1, 1)
         bias = self.bias(y).view(y.size(0), -1, 1, 1)
 
         if self.norm_style == 'bn':
@@ -208,7 +277,8 @@ class CCBN(nn.Module):
         else:
             raise ValueError('Unknown normalization style')
 
-        return out * gain + bias
+        # scale and shift in a single pass over the activation
+        return torch.addcmul(bias, out, gain)
 
     def extra_repr(self):
         s = 'out: {output_size}, in: {input_size},'
@@ -260,7 +330,8 @@ class GBlock(nn.Module):
         if self.learnable_sc:
             x = self.conv_sc(x)
 
-        return h + x
+        # h is a fresh conv output whose backward does not need it, so the residual can be added in place
+        return h.add_(x)
 
 
 # ----------------------- Discriminator block ----------------------- #
@@ -318,4 +389,5 @@ class DBlock(nn.Module):
         if self.downsample:
             h = self.downsample(h)
 
-        return h + self.shortcut(x)
+        # h is a fresh conv/pool output, so the residual can be added in place
+        return h.add_(self.shortcut(x))
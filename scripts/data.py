@@ -25,15 +25,18 @@ class Dataset:
         train_dataset = AradDataset(f'{self.dataset_path}/train', gen_dataset_path=gen_dataset_path,
                                     real=real, syn=syn, patch_size=self.patch_size, is_train=True)
         train_loader = data.DataLoader(train_dataset, batch_size=self.batch_size, shuffle=True,
-                                       num_workers=self.workers, pin_memory=True)
+                                       num_workers=self.workers, pin_memory=True,
+                                       persistent_workers=self.workers > 0)
 
         test_dataset = AradDataset(f'{self.dataset_path}/val', patch_size=self.patch_size, is_train=False)
         test_loader = data.DataLoader(test_dataset, batch_size=self.batch_size, shuffle=False,
-                                      num_workers=self.workers, pin_memory=True)
+                                      num_workers=self.workers, pin_memory=True,
+                                      persistent_workers=self.workers > 0)
 
         big_test_dataset = AradDataset(f'{self.dataset_path}/val', patch_size=256, is_train=False)
         big_test_loader = data.DataLoader(big_test_dataset, batch_size=self.batch_size, shuffle=False,
-                                          num_workers=self.workers, pin_memory=True)
+                                          num_workers=self.workers, pin_memory=True,
+                                          persistent_workers=self.workers > 0)
 
         return train_loader, (test_loader, big_test_loader)
 
@@ -1,3 +1,5 @@
+import os
+
 import torch
 
 
@@ -7,20 +9,20 @@ import torch
 
 
 def save_config(save_path, file, args):
-    txt_name = "/model_info.txt"
+    lines = ['#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#\n',
+             '             Model information             \n',
+             '#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#\n',
+             f'python {file} \\\n']
+
+    for arg, value in vars(args).items():
+        name = arg.replace('_', '-')
 
-    with open(save_path + txt_name, 'w') as txt:
-        txt.write('#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#\n')
-        txt.write('             Model information             \n')
-        txt.write('#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#\n')
-        txt.write(f'python {file} \\\n')
-        for arg in vars(args):
-            name = arg.replace('_', '-')
-            value = getattr(args, arg)
+        if isinstance(value, dict):
+            value = f'"{value}"'
+        lines.append(f'       --{name} {value} \\\n')
 
-            if isinstance(value, dict):
-                value = f'"{value}"'
-            txt.write(f'       --{name} {value} \\\n')
+    with open(os.path.join(save_path, 'model_info.txt'), 'w') as txt:
+        txt.writelines(lines)
 
 
 class AverageMeter(object):
@@ -32,14 +34,18 @@ class AverageMeter(object):
     def reset(self):
         self.val = 0
         self.avg = 0
-        self.sum = 0
         self.count = 0
 
     def update(self, val, n=1):
+        # callers may pass a (CUDA) tensor; sync it once here so the bookkeeping and every later
+        # read of val/avg are plain Python floats instead of 0-dim device tensors
+        if torch.is_tensor(val):
+            val = val.item()
+
         self.val = val
-        self.sum += val * n
         self.count += n
-        self.avg = self.sum / self.count
+        # running mean update; no unbounded sum to lose precision over long runs
+        self.avg += (val - self.avg) * (n / self.count)
 
 
 def accuracy(output, target, topk=(1,)):
@@ -47,12 +53,9 @@ def accuracy(output, target, topk=(1,)):
     maxk = max(topk)
     batch_size = target.size(0)
 
-    _, pred = output.float().topk(maxk, 1, True, True)
-    pred = pred.t()
-    correct = pred.eq(target.view(1, -1).expand_as(pred))
+    _, pred = output.to(torch.float32, copy=False).topk(maxk, 1, True, True)
+    correct = pred.eq(target[:, None]).float()
 
-    res = []
-    for k in topk:
-        correct_k = correct[:k].contiguous().view(-1).float().sum(0)
-        res.append(correct_k.mul_(100.0 / batch_size))
-    return res
+    # hits accumulated along the top-k axis, so each k is a single column read
+    correct = correct.cumsum(1)
+    return [correct[:, k - 1].sum().mul_(100.0 / batch_size) for k in topk]
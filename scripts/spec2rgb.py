@@ -123,6 +123,9 @@ class ColourSystem:
         # xyz -> rgb transformation matrix
         self.A = self.MI / self.wscale[:, np.newaxis]
 
+        # spectrum -> rgb matrix, kept on the device for spec_to_rgb_torch
+        self.M_torch = torch.tensor(self.get_transform_matrix(), dtype=torch.float32, device=device)
+
     def get_transform_matrix(self):
         XYZ = self.cmf
         RGB = XYZ.T @ self.A.T
@@ -137,7 +140,7 @@ class ColourSystem:
 
     def spec_to_rgb_torch(self, spec):  # between [-1, 1]
         """Convert a spectrum to an rgb value."""
-        M = torch.tensor(self.get_transform_matrix(), dtype=torch.float32).to(self.device)
+        M = self.M_torch.to(spec.dtype)
         # spec = (spec - torch.min(spec)) / (torch.max(spec) - torch.min(spec))
         rgb = torch.einsum('blmn,lk->bkmn', spec, M)
 